@@ -1,13 +1,18 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from dataclasses import dataclass
 import random, datetime, uuid, hashlib
 from typing import Literal, assert_never
+import numpy as np
 import uvicorn
 
 app = FastAPI(title="Mock Export Server")
 
+# CSV compresses well; level 1 keeps the CPU cost of compression low
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=1)
+
 # --- Spec Definition ---
 EventType = Literal["heart_rate", "spo2", "bp_sys", "bp_dia"]
 
@@ -27,17 +32,24 @@ class ExportSpec:
     step: datetime.timedelta
 
 
+# --- Generation Batch Size ---
+# Rows are drawn from the RNG a batch at a time, so the batch size is part of
+# what determines the generated data, not just how it is chunked.
+BATCH_ROWS = 8192
+
+
 # --- Value Generator Helper ---
 def normal_val(
-    rng: random.Random,
+    rng: np.random.Generator,
+    size: int,
     mean: float,
     stddev: float,
     min_val: int,
     max_val: int,
-) -> int:
-    """Generate a random integer from a normal distribution, clamped to bounds."""
-    val = int(rng.gauss(mean, stddev))
-    return max(min_val, min(max_val, val))
+) -> np.ndarray:
+    """Generate `size` random integers from a normal distribution, clamped to bounds."""
+    vals = rng.normal(mean, stddev, size).astype(np.int32)
+    return vals.clip(min_val, max_val)
 
 
 # --- Internal Data Model ---
@@ -52,47 +64,90 @@ class DownloadMeta(BaseModel):
     end_time: datetime.datetime
     step: datetime.timedelta
 
-    def csv(self, chunk_limit: int = 32 * 1024):
+    def csv(self, chunk_limit: int = 256 * 1024):
         """
         Yield CSV rows spaced by `step` with jitter in [0, step).
+
+        Patients, event types and times are drawn with NumPy for a whole
+        batch of `BATCH_ROWS` rows at once, values are sampled per event type
+        for the whole batch, and each batch is formatted in bulk from
+        pre-built row templates for every (patient, event type) pair.
+        Rows are accumulated as ASCII bytes and yielded in chunks of at least
+        `chunk_limit` bytes.
         """
-        rng = random.Random(self.id.bytes)
-        yield "patient_id,event_time,event_type,value\n"
-
-        rows_buf: list[str] = []
-        size = 0
-        curr_time = self.start_time
-        step_seconds = self.step.total_seconds()
-
-        for _ in range(self.rows):
-            patient_id = rng.choice(self.patients)
-            ts = curr_time + datetime.timedelta(seconds=rng.uniform(0, step_seconds))
-            event_type: EventType = rng.choice(self.event_types)
-
-            match event_type:
-                case "heart_rate":
-                    val = normal_val(rng, mean=75, stddev=15, min_val=30, max_val=200)
-                case "spo2":
-                    val = normal_val(rng, mean=97, stddev=2, min_val=70, max_val=100)
-                case "bp_sys":
-                    val = normal_val(rng, mean=120, stddev=20, min_val=60, max_val=250)
-                case "bp_dia":
-                    val = normal_val(rng, mean=80, stddev=15, min_val=30, max_val=150)
-                case _:
-                    assert_never(event_type)
-
-            line = f"{patient_id},{ts.isoformat()}Z,{event_type},{val}\n"
-            rows_buf.append(line)
-            size += len(line)
-            curr_time += self.step
-
-            if size >= chunk_limit:
-                yield "".join(rows_buf)
-                rows_buf.clear()
-                size = 0
-
-        if rows_buf:
-            yield "".join(rows_buf)
+        rng = np.random.default_rng(int.from_bytes(self.id.bytes, "little"))
+        yield b"patient_id,event_time,event_type,value\n"
+
+        buf = bytearray()
+        start_time = np.datetime64(self.start_time, "us")
+        step_us = self.step // datetime.timedelta(microseconds=1)
+        n_events = len(self.event_types)
+
+        # one row template per (patient, event type) pair, indexed by
+        # patient_idx * n_events + event_idx, leaving only time and value
+        templates = [
+            f"{patient_id},%sZ,{event_type},%d\n"
+            for patient_id in self.patients
+            for event_type in self.event_types
+        ]
+
+        for start in range(0, self.rows, BATCH_ROWS):
+            n = min(BATCH_ROWS, self.rows - start)
+
+            patient_idx = rng.integers(len(self.patients), size=n)
+            event_idx = rng.integers(n_events, size=n)
+
+            # integer microsecond offsets: row i is at i * step + jitter,
+            # with jitter in [0, step)
+            offsets = np.arange(start, start + n) * step_us + rng.integers(
+                step_us, size=n
+            )
+            times = np.datetime_as_string(
+                start_time + offsets.astype("timedelta64[us]"), unit="us"
+            ).tolist()
+
+            # fill values for all rows of each event type at once
+            vals = np.empty(n, dtype=np.int32)
+
+            for i, event_type in enumerate(self.event_types):
+                mask = event_idx == i
+                size = int(np.count_nonzero(mask))
+
+                match event_type:
+                    case "heart_rate":
+                        vals[mask] = normal_val(
+                            rng, size, mean=75, stddev=15, min_val=30, max_val=200
+                        )
+                    case "spo2":
+                        vals[mask] = normal_val(
+                            rng, size, mean=97, stddev=2, min_val=70, max_val=100
+                        )
+                    case "bp_sys":
+                        vals[mask] = normal_val(
+                            rng, size, mean=120, stddev=20, min_val=60, max_val=250
+                        )
+                    case "bp_dia":
+                        vals[mask] = normal_val(
+                            rng, size, mean=80, stddev=15, min_val=30, max_val=150
+                        )
+                    case _:
+                        assert_never(event_type)
+
+            template_idx = (patient_idx * n_events + event_idx).tolist()
+
+            buf += "".join(
+                [
+                    templates[i] % (ts, val)
+                    for i, ts, val in zip(template_idx, times, vals.tolist())
+                ]
+            ).encode("ascii")
+
+            if len(buf) >= chunk_limit:
+                yield bytes(buf)
+                buf.clear()
+
+        if buf:
+            yield bytes(buf)
 
 
 class ExportMeta(BaseModel):
@@ -274,7 +329,7 @@ def stream_download_data(export_id: str, download_id: uuid.UUID):
 
     data_meta = EXPORTS[export_id].downloads[download_id]
     return StreamingResponse(
-        content=data_meta.csv(chunk_limit=32 * 1024), media_type="text/csv"
+        content=data_meta.csv(chunk_limit=256 * 1024), media_type="text/csv"
     )
 
 
@@ -285,5 +340,4 @@ def main():
         host="0.0.0.0",
         workers=10,
         port=8000,
-        reload=True,
     )